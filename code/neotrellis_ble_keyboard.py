@@ -39,12 +39,16 @@
 #   https://github.com/pimoroni/pmk-circuitpython/blob/main/examples/obs-studio-toggle-and-mutex.py
 
 # Libraries (built-in)
+import array
+import gc
 import math
 import time
 import board
 import microcontroller
+import supervisor
 import usb_hid
 #import nvm
+from micropython import const
 from analogio import AnalogIn
 from digitalio import DigitalInOut, Direction, Pull
 
@@ -60,13 +64,19 @@ from adafruit_ble.services.standard.hid import HIDService
 from adafruit_ble.services.standard.device_info import DeviceInfoService
 from adafruit_ble.services.standard import BatteryService
 
-from adafruit_hid.keyboard import Keyboard
-from adafruit_hid.keyboard_layout_us import KeyboardLayoutUS
+from adafruit_hid import find_device
 from adafruit_hid.keycode import Keycode
 
 # When true keycodes are sent
 KC_LIVE = True
 
+# When non-zero debug messages are printed, when zero the compiler drops them
+DEBUG = const(0)
+
+# Modifier keycodes (LEFT_CONTROL to RIGHT_GUI), these are sent as bits in the report's first byte
+KC_MODIFIER_FIRST = const(0xE0)
+KC_MODIFIER_LAST  = const(0xE7)
+
 # LED Hues
 HUE_SPLIT = (1.0/24.0)
 hue = {
@@ -96,13 +106,22 @@ hue = {
     "mrr"     : (HUE_SPLIT * 23.0),
 }
 
-# LED Values (brightness)
-VAL_SPLIT = (1.0/32.0)
-VAL_MIN   = (VAL_SPLIT *  0.0)
-VAL_OFF   = (VAL_SPLIT *  2.0)
-VAL_ON    = (VAL_SPLIT * 30.0)
-VAL_MAX   = (VAL_SPLIT * 32.0)
-VAL_STEP  = 0.00005
+# Pad modes
+MODE_NONE   = const(0)
+MODE_KEY    = const(1)
+MODE_TOGGLE = const(2)
+MODE_GROUP  = const(3)
+
+# Integer hue range (6 sectors of 256)
+HUE_INT_RANGE = const(1536)
+
+# LED Values (brightness, 0-255)
+VAL_SPLIT = const(8)
+VAL_MIN   = const(VAL_SPLIT *  0)
+VAL_OFF   = const(VAL_SPLIT *  2)
+VAL_ON    = const(VAL_SPLIT * 30)
+VAL_MAX   = const((VAL_SPLIT * 32) - 1)
+VAL_STEP  = const(1)
 
 # Voltage colors
 VOLTAGE_RED     = 3.5
@@ -110,6 +129,23 @@ VOLTAGE_GREEN   = 4.1
 
 # Battery settings
 VOLTAGE_PERIOD = 60.0 # in seconds
+VOLTAGE_ALPHA  = 0.25 # weight of each new reading in the smoothed voltage
+
+# Battery gauge scale factors, per volt above VOLTAGE_RED
+VOLTAGE_SCALE_HUE     = (hue["green"] - hue["red"]) / (VOLTAGE_GREEN - VOLTAGE_RED)
+VOLTAGE_SCALE_PERCENT = 100.0 / (VOLTAGE_GREEN - VOLTAGE_RED)
+
+# Trellis settings
+SYNC_PERIOD_MS = const(20) # in milliseconds, the steady sync cadence
+SYNC_MIN_MS    = const(17) # in milliseconds, between the starts of two syncs, the trellis can only be read every 17 milliseconds or so
+SYNC_PERIOD_DISCONNECTED_MS = const(50) # in milliseconds, used while BLE is not connected
+
+# Tick settings, supervisor.ticks_ms() wraps at 2**29 so it is always a small int
+TICKS_MAX  = const((1 << 29) - 1)
+TICKS_HALF = const(1 << 28)
+
+# Connection display settings
+DOT_PERIOD_MS = const(150) # in milliseconds, between dot moves
 
 # Key configuration data
 #
@@ -152,134 +188,297 @@ config = [
     {"hue": hue["green"],   "group": None   , "keycodes_on": [Keycode.ALT,   Keycode.F14],         "keycodes_off": [Keycode.CONTROL, Keycode.F14]}  # F - Virtual Camera Start/Stop
 ]
 
-# Presses a list of keycodes
-def press_keycodes(kcs):
-    print(f'press_keycodes({kcs}), KC_LIVE={KC_LIVE}, ble.connected={ble.connected}')
-    if KC_LIVE and ble.connected:
-        if len(kcs) == 1:
-            keyboard.press(kcs[0])
-        elif len(kcs) == 2:
-            keyboard.press(kcs[0], kcs[1])
-        elif len(kcs) == 3:
-            keyboard.press(kcs[0], kcs[1], kcs[2])
-
-# Releases a list of keycodes
-def release_keycodes(kcs):
-    print(f'release_keycodes({kcs}), KC_LIVE={KC_LIVE}, ble.connected={ble.connected}')
-    if KC_LIVE and ble.connected:
-        if len(kcs) == 1:
-            keyboard.release(kcs[0])
-        elif len(kcs) == 2:
-            keyboard.release(kcs[0], kcs[1])
-        elif len(kcs) == 3:
-            keyboard.release(kcs[0], kcs[1], kcs[2])
+# Adds a list of keycodes to the keyboard report and sends it
+def report_press(kcs):
+    for kc in kcs:
+        # Modifier ?
+        if kc >= KC_MODIFIER_FIRST and kc <= KC_MODIFIER_LAST:
+            # Set modifier bit
+            kb_report[0] |= 1 << (kc - KC_MODIFIER_FIRST)
+        # Normal keycode ?
+        else:
+            # Find the first free keycode slot, unless already in the report
+            free = 0
+            for i in range(2, 8):
+                if kb_report[i] == kc:
+                    free = 0
+                    break
+                if free == 0 and kb_report[i] == 0:
+                    free = i
+            # Put keycode in the free slot
+            if free:
+                kb_report[free] = kc
+    kb_device.send_report(kb_report)
+
+# Removes a list of keycodes from the keyboard report and sends it
+def report_release(kcs):
+    for kc in kcs:
+        # Modifier ?
+        if kc >= KC_MODIFIER_FIRST and kc <= KC_MODIFIER_LAST:
+            # Clear modifier bit
+            kb_report[0] &= ~(1 << (kc - KC_MODIFIER_FIRST))
+        # Normal keycode ?
+        else:
+            # Clear the keycode's slot
+            for i in range(2, 8):
+                if kb_report[i] == kc:
+                    kb_report[i] = 0
+    kb_device.send_report(kb_report)
+
+# Presses a list of keycodes (KC_LIVE)
+def press_keycodes_live(kcs):
+    if DEBUG:
+        print(f'press_keycodes({kcs}), ble_connected={ble_connected}')
+    if ble_connected:
+        report_press(kcs)
+
+# Releases a list of keycodes (KC_LIVE)
+def release_keycodes_live(kcs):
+    if DEBUG:
+        print(f'release_keycodes({kcs}), ble_connected={ble_connected}')
+    if ble_connected:
+        report_release(kcs)
+
+# Ignores a list of keycodes (not KC_LIVE)
+def keycodes_disabled(kcs):
+    pass
+
+# Normal pad pressed
+def key_press(p):
+    # Press the on keycodes
+    press_keycodes(kc_on[p])
+
+# Toggle pad pressed
+def toggle_press(p):
+    # Toggle is currently on ?
+    if on[p]:
+        # Turn off
+        on[p] = False
+        # Press the off keycodes
+        press_keycodes(kc_off[p])
+    # Toggle is currently off ?
+    else:
+        # Turn on
+        on[p] = True
+        # Press the on keycodes
+        press_keycodes(kc_on[p])
+
+# Grouped pad pressed
+def group_press(p):
+    # Turn on the pressed pad
+    on[p] = True
+    # Press the on keycodes
+    press_keycodes(kc_on[p])
+    # Loop through the other pads in the same group as the pad that has just been pressed
+    for i in group_siblings[p]:
+        # The pad is on ?
+        if on[i]:
+            # Turn it off
+            on[i] = False
+            # Set val to minimum
+            val[i] = VAL_MIN
+            # Pad LED needs updating
+            dirty[i] = True
+
+# Normal or grouped pad released
+def key_release(p):
+    # Release on keycodes
+    release_keycodes(kc_on[p])
+
+# Toggle pad released
+def toggle_release(p):
+    # Pad has been toggled on ?
+    if on[p]:
+        # Release on keycodes
+        release_keycodes(kc_on[p])
+    # Pad has just been turned off ?
+    else:
+        # Release off keycodes
+        release_keycodes(kc_off[p])
+
+# Pad without a mode pressed or released
+def no_action(p):
+    pass
 
 # Keypad event callback
 def key_event(event):
+    global pads_update
+    # Pad number
+    p = event.number
+    # Pad LEDs need updating
+    pads_update = True
+    dirty[p] = True
     # key pressed when a rising edge is detected
     if event.edge == NeoTrellis.EDGE_RISING:
-        print(f'keypad press {event.number}')
+        if DEBUG:
+            print(f'keypad press {p}')
         # Pad is now down
-        config[event.number]["down"] = True
-        # Normal pad ?
-        if config[event.number]["mode"] == "key":
-            # Press the on keycodes
-            press_keycodes(config[event.number]["keycodes_on"])
-        # Toggle pad ?
-        elif config[event.number]["mode"] == "toggle":
-            # Toggle is currently on ?
-            if config[event.number]["on"]:
-                # Turn off
-                config[event.number]["on"] = False
-                # Press the off keycodes
-                press_keycodes(config[event.number]["keycodes_off"])
-            # Toggle is currently off ?
-            else:
-                # Turn on
-                config[event.number]["on"] = True
-                # Press the on keycodes
-                press_keycodes(config[event.number]["keycodes_on"])
-        # Grouped pad ?
-        elif config[event.number]["mode"] == "group":
-            # Turn on the pressed pad
-            config[event.number]["on"] = True
-            # Press the on keycodes
-            press_keycodes(config[event.number]["keycodes_on"])
-            # Loop through pads
-            for i in range(16):
-                # Not the pad that has just been pressed ?
-                if i != event.number:
-                    # This pad is in the same group as the pad that has just been pressed ?
-                    if config[i]["mode"] == "group" and config[i]["group"] == config[event.number]["group"]:
-                        # The pad is on ?
-                        if config[i]["on"]:
-                            # Turn it off
-                            config[i]["on"] = False
-                            # Set val to minimum
-                            config[i]["val"] = VAL_MIN
+        down[p] = True
+        # Carry out the press action for the pad's mode
+        press_action[p](p)
     # key released when a falling edge is detected
     elif event.edge == NeoTrellis.EDGE_FALLING:
-        print(f'keypad release {event.number}')
+        if DEBUG:
+            print(f'keypad release {p}')
         # Pad is not down
-        config[event.number]["down"] = False
-        # Normal pad ?
-        if config[event.number]["mode"] == "key":
-            # Release on keycodes
-            release_keycodes(config[event.number]["keycodes_on"])
-        # Toggle pad ?
-        elif config[event.number]["mode"] == "toggle":
-            # Pad has been toggled on ?
-            if config[event.number]["on"]:
-                # Release on keycodes
-                release_keycodes(config[event.number]["keycodes_on"])
-            # Pad has just been turned off ?
-            else:
-                # Release off keycodes
-                release_keycodes(config[event.number]["keycodes_off"])
-        # Grouped pad
-        elif config[event.number]["mode"] == "group":
-            # Release on keycodes
-            release_keycodes(config[event.number]["keycodes_on"])
+        down[p] = False
+        # Carry out the release action for the pad's mode
+        release_action[p](p)
 
 # Convert HSV to RGB
 def hsv_to_rgb(h, s, v):
-    # Convert an HSV (0.0-1.0) colour to RGB (0-255)
-    if s == 0.0:
-        rgb = [v, v, v]
-    i = int(h * 6.0)
-    f = (h*6.)-i; p,q,t = v*(1.-s), v*(1.-s*f), v*(1.-s*(1.-f)); i%=6
-    if i == 0:
-        rgb = [v, t, p]
-    if i == 1:
-        rgb = [q, v, p]
-    if i == 2:
-        rgb = [p, v, t]
-    if i == 3:
-        rgb = [p, q, v]
-    if i == 4:
-        rgb = [t, p, v]
-    if i == 5:
-        rgb = [v, p, q]
-    rgb = tuple(int(c * 255) for c in rgb)
-    return rgb
-
-def linear_scale(source_value, source_min, source_max, target_min, target_max):
-    """
-    Linearly scale a value from one range to another.
-
-    Args:
-        source_value (float): The value to be scaled.
-        source_min (float): The minimum value of the source range.
-        source_max (float): The maximum value of the source range.
-        target_min (float): The minimum value of the target range.
-        target_max (float): The maximum value of the target range.
-
-    Returns:
-        float: The scaled value in the target range.
-    """
-    return (source_value - source_min) * (target_max - target_min) / (source_max - source_min) + target_min
+    # Convert an HSV (0.0-1.0) colour to RGB (0-255) using the integer conversion
+    rgb = hsv_to_rgb_i(int(h * HUE_INT_RANGE), int(s * VAL_MAX), int(v * VAL_MAX))
+    return (rgb >> 16, (rgb >> 8) & 0xFF, rgb & 0xFF)
+
+# Sector shifts for hsv_to_rgb_i(), these place the value, rising/falling and
+# minimum channels into red (16), green (8) or blue (0)
+HSV_SHIFT_V = (16,  8,  8,  0,  0, 16)
+HSV_SHIFT_X = ( 8, 16,  0,  8, 16,  0)
+HSV_SHIFT_P = ( 0,  0, 16, 16,  8,  8)
+
+# Convert integer HSV to packed RGB
+def hsv_to_rgb_i(h, s, v):
+    # Convert an integer HSV (hue 0-1535, sat and val 0-255) colour to packed RGB (0xRRGGBB)
+    # Sector of the colour wheel and position within it
+    n = (h >> 8) % 6
+    f = h & 0xFF
+    # Even sectors rise rather than fall
+    if not n & 1:
+        f = 256 - f
+    # Minimum and rising/falling channels
+    p = ((256 - s) * v) >> 8
+    x = (v * (256 - ((s * f) >> 8))) >> 8
+    return (v << HSV_SHIFT_V[n]) | (x << HSV_SHIFT_X[n]) | (p << HSV_SHIFT_P[n])
+
+# Adds a delay in milliseconds to a tick count, wrapping like supervisor.ticks_ms()
+def ticks_add(ticks, delta):
+    return (ticks + delta) & TICKS_MAX
+
+# Signed difference in milliseconds between two tick counts, correct across a wrap
+def ticks_diff(ticks1, ticks2):
+    return ((ticks1 - ticks2 + TICKS_HALF) & TICKS_MAX) - TICKS_HALF
+
+# Update pad LEDs, returns True while any pad is still fading
+# (redraw checks every pad's colour after the LEDs have been used for something else)
+def update_pads(mode, down, on, val, dirty, rgb_unit, pixel_val, pixel_rgb, pixels, redraw):
+    # Assume all pads reach their targets this time
+    fading = False
+    # No LEDs written yet
+    written = False
+    # Loop through pads
+    for p in range(16):
+        # Pad settled at its target and LED not being redrawn ? Nothing to do
+        if not dirty[p] and not redraw:
+            continue
+        # Pad mode
+        m = mode[p]
+        # No mode ?
+        if m == MODE_NONE:
+            # LED not already off ?
+            if pixel_rgb[p] != 0:
+                pixel_rgb[p] = 0
+                # Turn off LED
+                pixels[p] = 0
+                written = True
+            # Pad LED is settled
+            dirty[p] = False
+        # Pad has a mode ?
+        else:
+            # Current value
+            cur = val[p]
+            # Pad is down ?
+            if down[p]:
+                if DEBUG:
+                    print(f'key {p} is down, mode is {m}, on is {on[p]}')
+                # Normal or grouped pad
+                if m == MODE_KEY or m == MODE_GROUP:
+                    # Go to full brightness
+                    cur = v = VAL_MAX
+                # Toggle pad?
+                elif m == MODE_TOGGLE:
+                    # Toggled on ?
+                    if on[p]:
+                        # Go to full brightness
+                        cur = v = VAL_MAX
+                    # Toggled off ?
+                    else:
+                        # Go to min brightness
+                        cur = v = VAL_MIN
+            # Pad is not down
+            else:
+                # Pad is on
+                if on[p]:
+                    # Set target on brightness
+                    v = VAL_ON
+                # Pad is off ?
+                else:
+                    # Set target off brightness
+                    v = VAL_OFF
+            # Step by sixteenths
+            if True:
+                # Target value above current value ? Move towards target
+                if v > cur:
+                    cur = min(cur + max((v - cur) >> 4, VAL_STEP), v)
+                # Target value below current value ? Move towards target
+                elif v < cur:
+                    cur = max(cur - max((cur - v) >> 4, VAL_STEP), v)
+            # Step by fixed amount
+            else:
+                # Target value above current value ? Move towards target
+                if v > cur:
+                    cur = min(cur + VAL_STEP, v)
+                # Target value below current value ? Move towards target
+                elif v < cur:
+                    cur = max(cur - VAL_STEP, v)
+            # Store new value
+            val[p] = cur
+            # Still fading ?
+            if cur != v:
+                fading = True
+            # Reached target ? Pad LED is settled
+            else:
+                dirty[p] = False
+            # LED not already showing this value ?
+            if redraw or pixel_rgb[p] < 0 or pixel_val[p] != cur:
+                pixel_val[p] = cur
+                # Scale the maximum value colour to packed RGB values.
+                scale = cur + 1
+                u = p * 3
+                rgb = (((rgb_unit[u] * scale) >> 8) << 16) | (((rgb_unit[u+1] * scale) >> 8) << 8) | ((rgb_unit[u+2] * scale) >> 8)
+                # LED colour changed ?
+                if rgb != pixel_rgb[p]:
+                    pixel_rgb[p] = rgb
+                    # Finally set the LED (pixels take packed RGB, so no tuple is needed)
+                    pixels[p] = rgb
+                    written = True
+    # Send all the written LEDs in one go
+    if written:
+        pixels.show()
+    return fading
+
+# Show a single connection display dot with all other LEDs off
+def show_dot(dot, rgb, pixel_rgb, pixels):
+    # No LEDs written yet
+    written = False
+    # Loop through LEDs
+    for p in range(16):
+        # Dot LED ?
+        if p == dot:
+            c = rgb
+        else:
+            c = 0
+        # LED colour changed ?
+        if c != pixel_rgb[p]:
+            pixel_rgb[p] = c
+            pixels[p] = c
+            written = True
+    # Send all the written LEDs in one go
+    if written:
+        pixels.show()
 
 def get_voltage():
+    global voltage_ewma
     # Get pin value
     value = voltage_pin.value
     # Calculate voltage
@@ -293,13 +492,18 @@ def get_voltage():
             microcontroller.nvm[0] = voltage_deci
         if voltage_deci > microcontroller.nvm[1]:
             microcontroller.nvm[1] = voltage_deci
+    # Smooth voltage (exponentially weighted moving average), so drops during BLE activity don't show
+    if voltage_ewma is None:
+        voltage_ewma = voltage
+    else:
+        voltage_ewma += (voltage - voltage_ewma) * VOLTAGE_ALPHA
     # Calculate voltage hue and percentage
-    if voltage <= VOLTAGE_RED:
+    if voltage_ewma <= VOLTAGE_RED:
         voltage_hue = hue["red"]
         voltage_percent = 0
-    elif voltage <= VOLTAGE_GREEN:
-        voltage_hue = linear_scale(voltage, VOLTAGE_RED, VOLTAGE_GREEN, hue["red"], hue["green"])
-        voltage_percent = int(linear_scale(voltage, VOLTAGE_RED, VOLTAGE_GREEN, 0, 100))
+    elif voltage_ewma <= VOLTAGE_GREEN:
+        voltage_hue = hue["red"] + ((voltage_ewma - VOLTAGE_RED) * VOLTAGE_SCALE_HUE)
+        voltage_percent = int((voltage_ewma - VOLTAGE_RED) * VOLTAGE_SCALE_PERCENT)
     else:
          voltage_hue = hue["green"]
          voltage_percent = 100
@@ -311,11 +515,13 @@ def get_voltage():
     if ble.connected:
         battery_service.level = voltage_percent
     # Debug
-    print(f'value={value}, voltage={voltage}, percent={voltage_percent}, hue={voltage_hue}, min={microcontroller.nvm[0]}, max={microcontroller.nvm[1]}, rec={voltage_record}')
+    if DEBUG:
+        print(f'value={value}, voltage={voltage}, ewma={voltage_ewma}, percent={voltage_percent}, hue={voltage_hue}, min={microcontroller.nvm[0]}, max={microcontroller.nvm[1]}, rec={voltage_record}')
     # Set timer
     return time.monotonic() + VOLTAGE_PERIOD
 
-print(f'len(microcontroller.nvm) = {len(microcontroller.nvm)}')
+if DEBUG:
+    print(f'len(microcontroller.nvm) = {len(microcontroller.nvm)}')
 
 # BLE disonnected pixel loops
 ble_not_advertising_pixels = [5, 6, 9, 10] # Inner 4
@@ -328,17 +534,17 @@ i2c_bus = board.I2C()  # uses board.SCL and board.SDA
 trellis = NeoTrellis(i2c_bus)
 trellis.brightness = 1.0
 # Turn on start up pixel
-r, g, b = hsv_to_rgb(hue["red"], 1.0, VAL_OFF)
+r, g, b = hsv_to_rgb(hue["red"], 1.0, VAL_OFF/VAL_MAX)
 trellis.pixels[ble_advertising_pixels[0]] = (r, g, b)
 time.sleep(0.05)
 
 # Setup on-board neopixel
-neopixel = neopixel.NeoPixel(board.NEOPIXEL, 1, brightness=(VAL_OFF/2), auto_write=True)
+neopixel = neopixel.NeoPixel(board.NEOPIXEL, 1, brightness=(VAL_OFF/VAL_MAX/2), auto_write=True)
 neopixel[0] = (255, 255, 255)
 trellis.pixels[ble_advertising_pixels[1]] = (r, g, b)
 time.sleep(0.05)
 
-# Setup the BLE keyboard and layout
+# Setup the BLE keyboard
 ble_connected = None
 hid = HIDService()
 battery_service = BatteryService()
@@ -365,20 +571,33 @@ scan_response.complete_name = "NeoTrellisCN"
 trellis.pixels[ble_advertising_pixels[5]] = (r, g, b)
 time.sleep(0.05)
 ble = adafruit_ble.BLERadio()
-print(f'init: ble.connected={ble.connected}, ble.advertising={ble.advertising}')
+if DEBUG:
+    print(f'init: ble.connected={ble.connected}, ble.advertising={ble.advertising}')
 ble.stop_advertising()
 ble.name = "NeoTrellisN"
+# Start advertising now so BLE comes up while the rest of the set up runs
+ble.start_advertising(advertisement, scan_response)
 trellis.pixels[ble_advertising_pixels[6]] = (r, g, b)
 time.sleep(0.05)
-keyboard = Keyboard(hid.devices)
+# Keyboard HID device (generic desktop usage page, keyboard usage)
+kb_device = find_device(hid.devices, usage_page=0x1, usage=0x06)
+# Keyboard HID report, modifier bits, reserved, then 6 keycode slots
+kb_report = bytearray(8)
 trellis.pixels[ble_advertising_pixels[7]] = (r, g, b)
 time.sleep(0.05)
-layout = KeyboardLayoutUS(keyboard)
+# Select keycode functions, KC_LIVE is fixed so only check it once
+if KC_LIVE:
+    press_keycodes = press_keycodes_live
+    release_keycodes = release_keycodes_live
+else:
+    press_keycodes = keycodes_disabled
+    release_keycodes = keycodes_disabled
 trellis.pixels[ble_advertising_pixels[8]] = (r, g, b)
 time.sleep(0.05)
 
 # GPIO
 voltage_record = False
+voltage_ewma = None
 voltage_pin = AnalogIn(board.VOLTAGE_MONITOR)
 voltage_timer = get_voltage()
 
@@ -398,36 +617,81 @@ blue_led.value = False
 trellis.pixels[ble_advertising_pixels[9]] = (r, g, b)
 time.sleep(0.05)
 
-# Add runtime data to config
+# Runtime data as parallel arrays, indexed by pad
+mode    = bytearray(16)
+down    = bytearray(16)
+on      = bytearray(16)
+val     = bytearray(16)
+hue_int = array.array('H', [0] * 16)
+sat     = bytearray(16)
+group   = [None] * 16
+kc_on   = [()] * 16
+kc_off  = [()] * 16
+
+# Fill runtime data from config, config is not used after this
 for p in range(16):
-    # Defaults
-    # Mode is none
-    config[p]["mode"] = None
-    # Set LED value to max
-    config[p]["val"] = VAL_MAX
-    # Not down
-    config[p]["down"] = False
-    # Not on
-    config[p]["on"] = False
+    # Defaults (from the zeroed arrays) are no mode, not down, not on and LED value min (not lit)
+    # Keycodes
+    kc_on[p] = tuple(config[p]["keycodes_on"] or ())
+    kc_off[p] = tuple(config[p]["keycodes_off"] or ())
+    # Group
+    group[p] = config[p]["group"]
+    # Pad has a hue ?
+    if config[p]["hue"] is not None:
+        # Integer hue
+        hue_int[p] = int(config[p]["hue"] * HUE_INT_RANGE)
+        # Full saturation
+        sat[p] = VAL_MAX
     # This is a toggle pad ?
-    if config[p]["keycodes_off"] != None and config[p]["keycodes_on"] != None and len(config[p]["keycodes_off"]) and len(config[p]["keycodes_on"]):
+    if len(kc_off[p]) and len(kc_on[p]):
         # Mode is toggle
-        config[p]["mode"] = "toggle"
+        mode[p] = MODE_TOGGLE
         # Can't be in a group
-        config[p]["group"] = None
+        group[p] = None
     # This is a grouped pad ?
-    if config[p]["group"] != None and len(config[p]["keycodes_on"]):
+    if group[p] != None and len(kc_on[p]):
         # Mode is group
-        config[p]["mode"] = "group"
+        mode[p] = MODE_GROUP
     # This is a key pad ?
-    if config[p]["mode"] == None and len(config[p]["keycodes_on"]):
+    if mode[p] == MODE_NONE and len(kc_on[p]):
         # Mode is key
-        config[p]["mode"] = "key"
-    # This key has not got a mode ?
-    if config[p]["mode"] == None:
-        # Set LED value to min (not lit)
-        config[p]["val"] = VAL_MIN
-    print(f'key={p}, mode={config[p]["mode"]}')
+        mode[p] = MODE_KEY
+    # This key has a mode ?
+    if mode[p] != MODE_NONE:
+        # Set LED value to max
+        val[p] = VAL_MAX
+    if DEBUG:
+        print(f'key={p}, mode={mode[p]}')
+
+# Other pads in the same group as each grouped pad, groups are fixed so only find them once
+group_siblings = [
+    tuple(i for i in range(16) if i != p and mode[i] == MODE_GROUP and group[i] == group[p])
+    if mode[p] == MODE_GROUP else ()
+    for p in range(16)
+]
+
+# Press and release actions for each pad, indexed by mode, modes are fixed so only pick them once
+press_action   = [(no_action, key_press,   toggle_press,   group_press)[mode[p]] for p in range(16)]
+release_action = [(no_action, key_release, toggle_release, key_release)[mode[p]] for p in range(16)]
+
+# Pad LED colours at maximum value, hue is fixed so only convert once (3 bytes per pad)
+rgb_unit = bytearray(48)
+for p in range(16):
+    rgb = hsv_to_rgb_i(hue_int[p], sat[p], VAL_MAX)
+    rgb_unit[p*3]     = rgb >> 16
+    rgb_unit[(p*3)+1] = (rgb >> 8) & 0xFF
+    rgb_unit[(p*3)+2] = rgb & 0xFF
+
+# Pad LED values and packed RGB colours last written to each LED (-1 forces a write)
+pixel_val = bytearray(16)
+pixel_rgb = [-1] * 16
+# Pad LEDs still moving towards their targets (all start dirty)
+dirty = bytearray(b'\x01' * 16)
+
+# Pad LEDs need updating (cleared once they have all reached their targets)
+pads_update = True
+# Pad LEDs need redrawing (set while the LEDs show the connection display)
+pads_redraw = True
 trellis.pixels[ble_advertising_pixels[10]] = (r, g, b)
 time.sleep(0.05)
 
@@ -442,41 +706,89 @@ for p in range(16):
 trellis.pixels[ble_advertising_pixels[11]] = (r, g, b)
 time.sleep(0.05)
 
+# Buffer trellis LED writes, the whole buffer is sent to the seesaw on each
+# write so the main loop sends it once per frame with show()
+trellis.pixels.auto_write = False
+
+# Connection display dot colours, these never change so only convert them once
+rgb_dot_red  = hsv_to_rgb_i(int(hue["red"] * HUE_INT_RANGE), VAL_MAX, VAL_OFF)
+rgb_dot_blue = hsv_to_rgb_i(int(hue["blue"] * HUE_INT_RANGE), VAL_MAX, VAL_OFF)
+
+# Objects, bound methods and lengths used in the main loop
+trellis_pixels = trellis.pixels
+trellis_sync = trellis.sync
+monotonic = time.monotonic
+ticks_ms = supervisor.ticks_ms
+sleep = time.sleep
+ble_advertising_pixels_len = len(ble_advertising_pixels)
+ble_not_advertising_pixels_len = len(ble_not_advertising_pixels)
+
+# Next trellis sync time
+sync_time = ticks_ms()
+# Next connection display dot move time
+dot_time = sync_time
+
+# All runtime state is now allocated, collect the start up garbage so the
+# main loop starts with an unfragmented heap
+gc.collect()
+if DEBUG:
+    print(f'gc.mem_free()={gc.mem_free()}')
+    # Frames where the sync scheduling and LED update allocated, should stay 0
+    mem_allocs = 0
+
 # Main loop
 while True:
 
+    # Read BLE state once per tick
+    connected = ble.connected
+    advertising = ble.advertising
+
     # Time to measure battery ?
-    now = time.monotonic()
+    now = monotonic()
     if now >= voltage_timer:
         voltage_timer = get_voltage()
-        print(f'timer: ble.connected={ble.connected}, ble.advertising={ble.advertising}')
-
-    # Connection debugging
-    if ble_connected != ble.connected:
-        ble_connected = ble.connected
-        print(f'conchange: ble.connected={ble.connected}, ble.advertising={ble.advertising}')
+        if DEBUG:
+            print(f'timer: ble.connected={connected}, ble.advertising={advertising}, gc.mem_free()={gc.mem_free()}, mem_allocs={mem_allocs}')
+            mem_allocs = 0
+
+    # Connection debugging, ble_connected is also used when sending keycodes
+    if ble_connected != connected:
+        ble_connected = connected
+        # Move the dot straight away once disconnected, ticks wrap so don't leave dot_time stale
+        dot_time = ticks_ms()
+        # Releases were not sent while disconnected, start again from an empty keyboard report
+        for i in range(8):
+            kb_report[i] = 0
+        if DEBUG:
+            print(f'conchange: ble.connected={connected}, ble.advertising={advertising}')
 
     # BLE is connected? Update advertising
-    if ble.connected:
+    if connected:
         # BLE is advertising ?
-        if ble.advertising:
-            print(f'ble.stop_advertising()')
+        if advertising:
+            if DEBUG:
+                print(f'ble.stop_advertising()')
             ble.stop_advertising()
+            advertising = False
     # BLE is not connected ? Update advertising
     else:
         # BLE is advertising ?
-        if ble.advertising:
+        if advertising:
             pass
         # BLE not advertising ?
         else:
             # Start advertising ?
-            print(f'ble.start_advertising()')
+            if DEBUG:
+                print(f'ble.start_advertising()')
             ble.start_advertising(advertisement, scan_response)
+            advertising = True
 
     # Switch changed
-    if switch_value != switch.value:
-        switch_value = switch.value
-        print(f'switch.value = {switch_value}')
+    switch_now = switch.value
+    if switch_value != switch_now:
+        switch_value = switch_now
+        if DEBUG:
+            print(f'switch.value = {switch_value}')
         # Switch pressed
         if switch_value == False:
             # Not already recording voltages?
@@ -487,140 +799,65 @@ while True:
                 voltage_record = True
                 red_led.value = voltage_record
 
+    # Wait for the next sync
+    sync_delay = ticks_diff(sync_time, ticks_ms())
+    if sync_delay > 0:
+        sleep(sync_delay / 1000)
     # call the sync function call any triggered callbacks
-    trellis.sync()
-    # the trellis can only be read every 17 millisecons or so
-    time.sleep(0.02)
+    sync_start = ticks_ms()
+    trellis_sync()
+    # Free memory after the sync, key event prints and the trellis library may allocate
+    if DEBUG:
+        mem_sync = gc.mem_free()
+    # Schedule the next sync from this one's deadline, so the cadence stays steady
+    # Sync less often when not connected, no keycodes can be sent
+    if connected:
+        sync_time = ticks_add(sync_time, SYNC_PERIOD_MS)
+    else:
+        sync_time = ticks_add(sync_time, SYNC_PERIOD_DISCONNECTED_MS)
+    # Running late ? Don't start the next sync too soon after this one started
+    if ticks_diff(sync_time, sync_start) < SYNC_MIN_MS:
+        sync_time = ticks_add(sync_start, SYNC_MIN_MS)
 
     # BLE connected? Update Neotrellis LEDs
-    if ble.connected:
+    if connected:
         # Normal operation
         if True:
-            # Loop through pads
-            for p in range(16):
-                # Start with LED off
-                h = 0.0
-                s = 0.0
-                v = 0.0
-                # No mode ?
-                if config[p]["mode"] == None:
-                    # Turn off LED
-                    trellis.pixels[i] = (0, 0, 0)
-                # Pad has a mode ?
-                else:
-                    # Pad is down ?
-                    if config[p]["down"]:
-                        print(f'key {p} is down, mode is {config[p]["mode"]}, on is {config[p]["on"]}')
-                        # Normal or grouped pad
-                        if config[p]["mode"] == "key" or config[p]["mode"] == "group":
-                            # Go to full brightness
-                            config[p]["val"] = v = VAL_MAX
-                        # Toggle pad?
-                        elif config[p]["mode"] == "toggle":
-                            print("toggle down")
-                            # Toggled on ?
-                            if config[p]["on"]:
-                                # Go to full brightness
-                                config[p]["val"] = v = VAL_MAX
-                                print("toggle down max")
-                            # Toggled off ?
-                            else:
-                                # Go to min brightness
-                                config[p]["val"] = v = VAL_MIN
-                                print("toggle down min")
-                    # Pad is not down
-                    else:
-                        # Pad is on
-                        if config[p]["on"]:
-                            # Set target on brightness
-                            v = VAL_ON
-                        # Pad is off ?
-                        else:
-                            # Set target off brightness
-                            v = VAL_OFF
-                    # Step by eighths
-                    if True:
-                        # Target value above current value ?
-                        if v > config[p]["val"]:
-                            step = (v - config[p]["val"]) / 16
-                            # Move towards target
-                            if step > VAL_STEP:
-                                config[p]["val"] += step
-                            else:
-                                config[p]["val"] = v
-                        # Target value below current value
-                        elif v < config[p]["val"]:
-                            step = (config[p]["val"] - v) / 16
-                            # Move towards target
-                            if step > VAL_STEP:
-                                config[p]["val"] -= step
-                            else:
-                                config[p]["val"] = v
-                    # Step by fixed amount
-                    else:
-                        # Target value above current value ?
-                        if v > config[p]["val"]:
-                            # Move towards target
-                            if v - config[p]["val"] > VAL_STEP:
-                                config[p]["val"] += VAL_STEP
-                            else:
-                                config[p]["val"] = v
-                        # Target value below current value
-                        elif v < config[p]["val"]:
-                            # Move towards target
-                            if config[p]["val"] - v > VAL_STEP:
-                                config[p]["val"] -= VAL_STEP
-                            else:
-                                config[p]["val"] = v
-                    # Pad has a hue ?
-                    if config[p]["hue"] is not None:
-                        # Set full saturation
-                        s = 1.0
-                        # Set hue
-                        h = config[p]["hue"]
-                    else:
-                        s = 0.0
-                        h = 0.0
-                    # Convert the hue to RGB values.
-                    r, g, b = hsv_to_rgb(h, s, config[p]["val"])
-                    # Finally set the LED
-                    trellis.pixels[p] = (r, g, b)
+            # Pad LEDs need updating ?
+            if pads_update or pads_redraw:
+                pads_update = update_pads(mode, down, on, val, dirty, rgb_unit, pixel_val, pixel_rgb, trellis_pixels, pads_redraw)
+                pads_redraw = False
         # Test operation
         else:
             # Cycle BLE advertising pixels dim red
-            if ble_advertising_pixel_index >= len(ble_advertising_pixels):
+            if ble_advertising_pixel_index >= ble_advertising_pixels_len:
                 ble_advertising_pixel_index = 0
-            r, g, b = hsv_to_rgb(hue["red"], 1.0, VAL_OFF)
-            for p in range(16):
-                if p == ble_advertising_pixels[ble_advertising_pixel_index]:
-                    trellis.pixels[p] = (r, g, b)
-                else:
-                    trellis.pixels[p] = (0, 0, 0)
+            show_dot(ble_advertising_pixels[ble_advertising_pixel_index], rgb_dot_red, pixel_rgb, trellis_pixels)
+            pads_redraw = True
             ble_advertising_pixel_index += 1
     # BLE not connected? Update Neotrellis LEDs
     else:
-        # Advertising
-        if ble.advertising:
-            # Cycle BLE advertising pixels
-            if ble_advertising_pixel_index >= len(ble_advertising_pixels):
-                ble_advertising_pixel_index = 0
-            r, g, b = hsv_to_rgb(hue["blue"], 1.0, VAL_OFF)
-            for p in range(16):
-                if p == ble_advertising_pixels[ble_advertising_pixel_index]:
-                    trellis.pixels[p] = (r, g, b)
-                else:
-                    trellis.pixels[p] = (0, 0, 0)
-            ble_advertising_pixel_index += 1
-        # Not advertising
-        else:
-            # Cycle BLE not advertising pixels
-            if ble_advertising_pixel_index >= len(ble_not_advertising_pixels):
-                ble_advertising_pixel_index = 0
-            r, g, b = hsv_to_rgb(hue["blue"], 1.0, VAL_OFF)
-            for p in range(16):
-                if p == ble_not_advertising_pixels[ble_advertising_pixel_index]:
-                    trellis.pixels[p] = (r, g, b)
-                else:
-                    trellis.pixels[p] = (0, 0, 0)
-            ble_advertising_pixel_index += 1
-
+        # Pads need redrawing when connected
+        pads_redraw = True
+        # Time to move the dot ?
+        dot_now = ticks_ms()
+        if ticks_diff(dot_now, dot_time) >= 0:
+            dot_time = ticks_add(dot_now, DOT_PERIOD_MS)
+            # Advertising
+            if advertising:
+                # Cycle BLE advertising pixels
+                if ble_advertising_pixel_index >= ble_advertising_pixels_len:
+                    ble_advertising_pixel_index = 0
+                show_dot(ble_advertising_pixels[ble_advertising_pixel_index], rgb_dot_blue, pixel_rgb, trellis_pixels)
+                ble_advertising_pixel_index += 1
+            # Not advertising
+            else:
+                # Cycle BLE not advertising pixels
+                if ble_advertising_pixel_index >= ble_not_advertising_pixels_len:
+                    ble_advertising_pixel_index = 0
+                show_dot(ble_not_advertising_pixels[ble_advertising_pixel_index], rgb_dot_blue, pixel_rgb, trellis_pixels)
+                ble_advertising_pixel_index += 1
+
+    # Scheduling or LED update allocated ?
+    if DEBUG and gc.mem_free() < mem_sync:
+        mem_allocs += 1